@@ -1,20 +1,32 @@
-from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Form
+from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Form, BackgroundTasks
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import AsyncMongoClient, ReturnDocument
+from gridfs import AsyncGridFSBucket
+from gridfs.errors import NoFile
+from jsonschema import Draft202012Validator
+from jsonschema.exceptions import best_match
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
+from collections import OrderedDict
 import uuid
-from datetime import datetime
-import base64
+from datetime import datetime, timedelta, timezone
+import hashlib
 import json
+import re
+import orjson
 import tempfile
 import asyncio
-import io
+import functools
+import math
+import time
 import numpy as np
+import librosa
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -24,8 +36,28 @@ GOOGLE_SERVICE_ACCOUNT_FILE = ROOT_DIR / 'google-service-account.json'
 GDRIVE_EXPORTS_FOLDER_ID = "1S-rhyyGgl6O-5g1d4sZzKiDBO9xoQsZJ"  # EXPORTS folder
 GDRIVE_MULTI_FOLDER_ID = "1mr9CrmjTijaLEKtNf2WtuVNSSnetQ3am"    # MULTI folder
 
+# LLM replies may wrap their JSON in a ```json ... ``` fence
+JSON_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+
+# Uploads are streamed to disk in 1 MiB chunks
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Analyses are cached by audio content hash; entries expire after 30 days
+AUDIO_ANALYSIS_CACHE_TTL_SECONDS = 30 * 24 * 3600
+
+# Lyric breakdowns are cached by normalized input hash; entries expire after 7 days
+BREAKDOWN_CACHE_TTL_SECONDS = 7 * 24 * 3600
+
+# Built on first use and shared; None until Drive credentials load successfully
+drive_service = None
+drive_credentials = None
+
 def get_google_drive_service():
-    """Initialize Google Drive service using service account credentials"""
+    """Google Drive service from the service account credentials, built once per process"""
+    global drive_service, drive_credentials
+    if drive_service is not None:
+        return drive_service
+    
     try:
         from google.oauth2 import service_account
         from googleapiclient.discovery import build
@@ -37,33 +69,55 @@ def get_google_drive_service():
             str(GOOGLE_SERVICE_ACCOUNT_FILE),
             scopes=['https://www.googleapis.com/auth/drive.file']
         )
-        service = build('drive', 'v3', credentials=credentials)
-        return service
+        drive_service = build('drive', 'v3', credentials=credentials, cache_discovery=False)
+        drive_credentials = credentials
+        return drive_service
     except Exception as e:
         logging.error(f"Failed to initialize Google Drive: {e}")
         return None
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncMongoClient(
+    mongo_url,
+    maxPoolSize=200,
+    minPoolSize=20,  # keep warm sockets for bursts of storyboard traffic
+    maxIdleTimeMS=60000,
+    serverSelectionTimeoutMS=5000,
+    retryWrites=True,
+    compressors="zstd"  # storyboard writes carry long description strings
+)
 db = client[os.environ['DB_NAME']]
 
+# Uploaded audio lives in GridFS; projects only keep its audio_file_id
+audio_bucket = AsyncGridFSBucket(db, bucket_name="audio")
+
+# Projects uploaded before GridFS carry an inline base64 copy - never read it back
+PROJECT_PROJECTION = {"audio_data": 0}
+
 # Create the main app without a prefix
-app = FastAPI(title="LyricSiNMotion API", version="1.0.0")
+app = FastAPI(title="LyricSiNMotion API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
-# Configure logging
+# Configure logging - set LOG_LEVEL=WARNING in production
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
 logging.basicConfig(
-    level=logging.INFO,
+    level=LOG_LEVEL,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
+# Uvicorn logs every request at INFO; above INFO, drop access logging entirely
+logging.getLogger("uvicorn.access").setLevel(LOG_LEVEL)
+
 
 # ===================== AUDIO ANALYSIS FUNCTIONS =====================
 
+ANALYSIS_SAMPLE_RATE = 11025
+RMS_FRAME_LENGTH = 2048  # ~186 ms at 11.025 kHz, non-overlapping
+
 def analyze_audio_file(file_path: str) -> Dict[str, Any]:
     """
     Analyze audio file using librosa to extract:
@@ -73,15 +127,26 @@ def analyze_audio_file(file_path: str) -> Dict[str, Any]:
     - Section detection (verse, chorus, etc.)
     """
     try:
-        import librosa
-        
-        # Load audio file
-        y, sr = librosa.load(file_path, sr=22050)
+        # Load audio file - 11.025 kHz mono is plenty for tempo and energy
+        y, sr = librosa.load(file_path, sr=ANALYSIS_SAMPLE_RATE, mono=True)
         duration = librosa.get_duration(y=y, sr=sr)
         
+        # Zero-length audio has no beats or segments to analyse
+        if len(y) == 0:
+            return {
+                "duration": 0.0,
+                "tempo": 0.0,
+                "total_beats": 0,
+                "beat_times": [],
+                "num_segments": 0,
+                "segments": [],
+                "avg_energy": 0.0,
+                "energy_variance": 0.0
+            }
+        
         # Tempo and beat detection
         tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
-        beat_times = librosa.frames_to_time(beat_frames, sr=sr).tolist()
+        beat_times = librosa.frames_to_time(beat_frames, sr=sr)
         
         # Handle tempo - convert to float properly
         if hasattr(tempo, '__len__'):
@@ -89,80 +154,69 @@ def analyze_audio_file(file_path: str) -> Dict[str, Any]:
         else:
             tempo = float(tempo)
         
-        # Energy analysis (RMS)
-        rms = librosa.feature.rms(y=y)[0]
+        # Energy analysis (RMS) - only per-segment averages are needed, so use coarse frames
+        rms = librosa.feature.rms(y=y, frame_length=RMS_FRAME_LENGTH, hop_length=RMS_FRAME_LENGTH)[0]
         
         # Segment audio into 8-second blocks
         segment_duration = 8.0
         num_segments = int(np.ceil(duration / segment_duration))
         
-        segments = []
-        samples_per_segment = int(segment_duration * sr)
+        # Segment boundaries in seconds, then in RMS frames (num_segments + 1 edges)
+        edges = np.minimum(np.arange(num_segments + 1) * segment_duration, duration)
         rms_per_frame = len(y) / len(rms)
+        frame_edges = np.minimum((edges * sr).astype(np.int64) / rms_per_frame, len(rms)).astype(np.int64)
         
-        for i in range(num_segments):
-            start_time = i * segment_duration
-            end_time = min((i + 1) * segment_duration, duration)
-            
-            # Get samples for this segment
-            start_sample = int(start_time * sr)
-            end_sample = int(end_time * sr)
-            segment_audio = y[start_sample:end_sample]
-            
-            # Calculate energy for this segment
-            start_frame = int(start_sample / rms_per_frame)
-            end_frame = int(end_sample / rms_per_frame)
-            segment_rms = rms[start_frame:end_frame]
-            avg_energy = float(np.mean(segment_rms)) if len(segment_rms) > 0 else 0.5
-            
-            # Normalize energy to 0-1 scale
-            max_rms = float(np.max(rms)) if np.max(rms) > 0 else 1.0
-            normalized_energy = avg_energy / max_rms
-            
-            # Count beats in this segment
-            segment_beats = [b for b in beat_times if start_time <= b < end_time]
-            beat_density = len(segment_beats) / segment_duration
-            
-            # Determine intensity level
-            if normalized_energy > 0.7:
-                intensity = "high"
-            elif normalized_energy > 0.4:
-                intensity = "medium"
-            else:
-                intensity = "low"
-            
-            # Estimate section type based on position and energy
-            position_ratio = i / num_segments
-            if position_ratio < 0.1:
-                section_type = "intro"
-            elif position_ratio > 0.9:
-                section_type = "outro"
-            elif normalized_energy > 0.6 and beat_density > 1.5:
-                section_type = "chorus"
-            elif normalized_energy < 0.3:
-                section_type = "bridge"
-            else:
-                section_type = "verse"
-            
-            segments.append({
+        # Mean RMS per segment from one cumulative sum; empty segments fall back to 0.5
+        rms_cumsum = np.concatenate(([0.0], np.cumsum(rms, dtype=np.float64)))
+        frame_counts = np.diff(frame_edges)
+        segment_sums = rms_cumsum[frame_edges[1:]] - rms_cumsum[frame_edges[:-1]]
+        avg_energy = np.where(frame_counts > 0, segment_sums / np.maximum(frame_counts, 1), 0.5)
+        
+        # Normalize energy to 0-1 scale
+        rms_max = float(rms.max())
+        max_rms = rms_max if rms_max > 0 else 1.0
+        energy = avg_energy / max_rms
+        
+        # Count beats per segment - beat_times is sorted, so bisect the edges
+        beats_in_segment = np.diff(np.searchsorted(beat_times, edges))
+        beat_density = beats_in_segment / segment_duration
+        
+        # Determine intensity level
+        intensity = np.select([energy > 0.7, energy > 0.4], ["high", "medium"], default="low")
+        
+        # Estimate section type based on position and energy
+        position_ratio = np.arange(num_segments) / num_segments
+        section_type = np.select(
+            [position_ratio < 0.1, position_ratio > 0.9, (energy > 0.6) & (beat_density > 1.5), energy < 0.3],
+            ["intro", "outro", "chorus", "bridge"],
+            default="verse"
+        )
+        
+        segments = [
+            {
                 "segment_number": i + 1,
                 "start_time": round(start_time, 2),
                 "end_time": round(end_time, 2),
-                "energy": round(normalized_energy, 3),
-                "intensity": intensity,
-                "beat_density": round(beat_density, 2),
-                "beats_in_segment": len(segment_beats),
-                "section_type": section_type
-            })
+                "energy": round(seg_energy, 3),
+                "intensity": seg_intensity,
+                "beat_density": round(density, 2),
+                "beats_in_segment": beats,
+                "section_type": seg_section
+            }
+            for i, (start_time, end_time, seg_energy, seg_intensity, density, beats, seg_section) in enumerate(zip(
+                edges[:-1].tolist(), edges[1:].tolist(), energy.tolist(), intensity.tolist(),
+                beat_density.tolist(), beats_in_segment.tolist(), section_type.tolist()
+            ))
+        ]
         
         return {
             "duration": round(duration, 2),
             "tempo": round(tempo, 1),
             "total_beats": len(beat_times),
-            "beat_times": beat_times[:50],  # First 50 beats for reference
+            "beat_times": beat_times[:50].tolist(),  # First 50 beats for reference
             "num_segments": num_segments,
             "segments": segments,
-            "avg_energy": round(float(np.mean(rms)) / max_rms, 3),
+            "avg_energy": round(float(rms_cumsum[-1]) / len(rms) / max_rms, 3),  # mean from the cumsum
             "energy_variance": round(float(np.std(rms)), 4)
         }
         
@@ -206,8 +260,8 @@ class AudioAnalysis(BaseModel):
 class Project(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     status: str = "draft"  # draft, processing, storyboard_ready, video_ready
     audio_filename: Optional[str] = None
     audio_duration: Optional[float] = None
@@ -217,6 +271,19 @@ class Project(BaseModel):
     storyboard: Optional[List[StoryboardScene]] = None
     video_url: Optional[str] = None  # Mock video URL
 
+class ProjectSummary(BaseModel):
+    """List-view subset of Project - excludes storyboard, analysis and audio data"""
+    id: str
+    name: str
+    created_at: datetime
+    updated_at: datetime
+    status: str = "draft"
+    audio_filename: Optional[str] = None
+    audio_duration: Optional[float] = None
+
+# Server-side projection matching ProjectSummary
+PROJECT_SUMMARY_PROJECTION = {field: 1 for field in ProjectSummary.model_fields} | {"_id": 0}
+
 class ProjectCreate(BaseModel):
     name: str
 
@@ -245,6 +312,70 @@ class SceneUpdateRequest(BaseModel):
     mood: Optional[str] = None
     character_actions: Optional[str] = None
 
+# ===================== PROJECT READ CACHE =====================
+
+PROJECT_CACHE_CAPACITY = 1024
+
+# The cache and its invalidation are per worker: a write handled by one worker can't
+# evict another worker's copy. So it is only on by default for a single worker
+# (WEB_CONCURRENCY unset or 1); set PROJECT_CACHE_TTL_SECONDS=0 when running more
+# workers through gunicorn -w, which does not export WEB_CONCURRENCY.
+PROJECT_CACHE_TTL_SECONDS = float(os.environ.get(
+    'PROJECT_CACHE_TTL_SECONDS',
+    '2' if int(os.environ.get('WEB_CONCURRENCY', '1')) <= 1 else '0'
+))
+
+# project_id -> (expires_at, document). Every write to a project must call invalidate_project().
+project_cache: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+
+# A read that was in flight when its project was invalidated must not refill the cache
+# with the pre-write document. Invalidations are numbered; project_invalidations keeps
+# the latest number per project, and project_invalidation_floor is an upper bound for
+# the numbers of entries evicted from it.
+project_invalidation_seq = 0
+project_invalidation_floor = 0
+project_invalidations: "OrderedDict[str, int]" = OrderedDict()
+
+async def load_project(project_id: str) -> Optional[dict]:
+    """Read a project through the short-lived cache. Treat the result as read-only."""
+    now = time.monotonic()
+    entry = project_cache.get(project_id)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+    
+    read_seq = project_invalidation_seq
+    project = await db.projects.find_one({"id": project_id}, PROJECT_PROJECTION)
+    last_invalidated = project_invalidations.get(project_id, project_invalidation_floor)
+    if project is not None and PROJECT_CACHE_TTL_SECONDS > 0 and last_invalidated <= read_seq:
+        project_cache[project_id] = (time.monotonic() + PROJECT_CACHE_TTL_SECONDS, project)
+        project_cache.move_to_end(project_id)
+        while len(project_cache) > PROJECT_CACHE_CAPACITY:
+            project_cache.popitem(last=False)
+    return project
+
+def invalidate_project(project_id: str):
+    global project_invalidation_seq, project_invalidation_floor
+    project_cache.pop(project_id, None)
+    
+    project_invalidation_seq += 1
+    project_invalidations[project_id] = project_invalidation_seq
+    project_invalidations.move_to_end(project_id)
+    while len(project_invalidations) > PROJECT_CACHE_CAPACITY:
+        _, evicted_seq = project_invalidations.popitem(last=False)
+        project_invalidation_floor = max(project_invalidation_floor, evicted_seq)
+
+async def raise_for_unmatched(project_id: str, detail, status_code: int = 400, projection: Optional[dict] = None):
+    """
+    A conditional project write matched nothing: raise 404 if the project is missing,
+    else the precondition error. This second lookup only runs on that failure path.
+    detail may be a function of the project document read with `projection`.
+    """
+    project = await db.projects.find_one({"id": project_id}, projection or {"_id": 1})
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    raise HTTPException(status_code=status_code, detail=detail(project) if callable(detail) else detail)
+
+
 # ===================== ROUTES =====================
 
 @api_router.get("/")
@@ -259,77 +390,168 @@ async def health_check():
 @api_router.post("/projects", response_model=Project)
 async def create_project(project_input: ProjectCreate):
     project = Project(name=project_input.name)
-    await db.projects.insert_one(project.dict())
+    await db.projects.insert_one(project.model_dump())
     return project
 
-@api_router.get("/projects", response_model=List[Project])
+@api_router.get("/projects", response_model=List[ProjectSummary])
 async def get_projects():
-    projects = await db.projects.find().sort("created_at", -1).to_list(100)
-    return [Project(**p) for p in projects]
+    projects = await db.projects.find({}, PROJECT_SUMMARY_PROJECTION).sort("created_at", -1).to_list(100)
+    return projects  # validated once by response_model
 
 @api_router.get("/projects/{project_id}", response_model=Project)
 async def get_project(project_id: str):
-    project = await db.projects.find_one({"id": project_id})
+    project = await load_project(project_id)
     if not project:
         raise HTTPException(status_code=404, detail="Project not found")
-    return Project(**project)
+    return project
 
 @api_router.put("/projects/{project_id}", response_model=Project)
 async def update_project(project_id: str, update: ProjectUpdate):
-    project = await db.projects.find_one({"id": project_id})
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-    
-    update_data = {k: v for k, v in update.dict().items() if v is not None}
-    update_data["updated_at"] = datetime.utcnow()
+    update_data = update.model_dump(exclude_none=True)
+    update_data["updated_at"] = datetime.now(timezone.utc)
     
-    await db.projects.update_one({"id": project_id}, {"$set": update_data})
-    updated = await db.projects.find_one({"id": project_id})
-    return Project(**updated)
+    updated = await db.projects.find_one_and_update(
+        {"id": project_id},
+        {"$set": update_data},
+        projection=PROJECT_PROJECTION,
+        return_document=ReturnDocument.AFTER
+    )
+    invalidate_project(project_id)
+    if not updated:
+        raise HTTPException(status_code=404, detail="Project not found")
+    return updated
 
 @api_router.delete("/projects/{project_id}")
 async def delete_project(project_id: str):
-    result = await db.projects.delete_one({"id": project_id})
-    if result.deleted_count == 0:
+    deleted = await db.projects.find_one_and_delete({"id": project_id}, projection={"audio_file_id": 1})
+    invalidate_project(project_id)
+    if not deleted:
         raise HTTPException(status_code=404, detail="Project not found")
+    if deleted.get("audio_file_id"):
+        await delete_audio_file(deleted["audio_file_id"])
     return {"message": "Project deleted successfully"}
 
+async def store_audio_file(path: str, filename: str, project_id: str):
+    """Copy a spooled upload into GridFS chunk by chunk and return the new file id"""
+    grid_in = audio_bucket.open_upload_stream(filename, metadata={"project_id": project_id})
+    try:
+        with open(path, 'rb') as f:
+            while chunk := f.read(UPLOAD_CHUNK_SIZE):
+                await grid_in.write(chunk)
+        await grid_in.close()
+    except BaseException:
+        # Failed or cancelled copies must not leave their chunks behind in audio.chunks
+        await grid_in.abort()
+        raise
+    return grid_in._id
+
+async def discard_audio_copy(task: asyncio.Task):
+    """Cancel an in-flight store_audio_file task, or delete its file if it already finished"""
+    task.cancel()
+    try:
+        file_id = await task
+    except BaseException:
+        return  # the copy aborted itself
+    await delete_audio_file(file_id)
+
+async def delete_audio_file(file_id):
+    try:
+        await audio_bucket.delete(file_id)
+    except NoFile:
+        pass
+
+async def spool_upload(upload: UploadFile) -> Tuple[str, str]:
+    """
+    Stream an upload to a temp file one chunk at a time.
+    Returns the temp file path and the SHA-256 hex digest of the content.
+    """
+    hasher = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(suffix='.mp3', delete=False) as tmp_file:
+        try:
+            while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                tmp_file.write(chunk)
+                hasher.update(chunk)
+        except BaseException:
+            # Client disconnects and cancellation must not leave the file behind
+            tmp_file.close()
+            os.unlink(tmp_file.name)
+            raise
+        return tmp_file.name, hasher.hexdigest()
+
+async def get_audio_analysis(path: str, content_hash: str) -> Dict[str, Any]:
+    # Re-uploads of the same file reuse the stored analysis
+    cached = await db.audio_analysis_cache.find_one({"_id": content_hash})
+    if cached:
+        return cached["analysis"]
+    
+    # REAL audio analysis using librosa - CPU-bound, so keep it off the event loop
+    analysis = await asyncio.to_thread(analyze_audio_file, path)
+    if "error" not in analysis:  # never cache the fallback analysis
+        await db.audio_analysis_cache.update_one(
+            {"_id": content_hash},
+            {"$set": {"analysis": analysis, "created_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+    return analysis
+
 # Audio Upload with REAL analysis
 @api_router.post("/projects/{project_id}/audio")
 async def upload_audio(project_id: str, audio: UploadFile = File(...)):
-    project = await db.projects.find_one({"id": project_id})
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-    
     # Validate file type
     if not audio.filename.lower().endswith(('.mp3', '.wav', '.m4a', '.ogg', '.flac')):
         raise HTTPException(status_code=400, detail="Supported formats: MP3, WAV, M4A, OGG, FLAC")
     
-    # Save audio temporarily for analysis
-    content = await audio.read()
-    
-    with tempfile.NamedTemporaryFile(suffix='.mp3', delete=False) as tmp_file:
-        tmp_file.write(content)
-        tmp_path = tmp_file.name
+    # Check the project exists while the upload streams to disk. Wait for both legs,
+    # so a failed lookup can't leave the spooled file behind.
+    project, spooled = await asyncio.gather(
+        db.projects.find_one({"id": project_id}, {"_id": 1}),
+        spool_upload(audio),
+        return_exceptions=True
+    )
+    if isinstance(spooled, BaseException):
+        raise spooled
+    tmp_path, content_hash = spooled
     
     try:
-        # REAL audio analysis using librosa
-        analysis = analyze_audio_file(tmp_path)
+        if isinstance(project, BaseException):
+            raise project
         
-        # Store audio data in database for later use
-        audio_data = base64.b64encode(content).decode('utf-8')
+        # Analysis is too expensive to run for a missing project
+        if not project:
+            raise HTTPException(status_code=404, detail="Project not found")
         
-        # Update project with analysis
-        await db.projects.update_one(
+        # Analysis and the GridFS copy (for playback reference) share nothing, so overlap them.
+        # If either fails or the client goes away, the copy must not outlive the request.
+        store_task = asyncio.ensure_future(store_audio_file(tmp_path, audio.filename, project_id))
+        try:
+            analysis = await get_audio_analysis(tmp_path, content_hash)
+            audio_file_id = await store_task
+        except BaseException:
+            await discard_audio_copy(store_task)
+            raise
+        
+        # Update project with analysis, dropping any legacy inline copy of the audio
+        previous = await db.projects.find_one_and_update(
             {"id": project_id},
-            {"$set": {
-                "audio_filename": audio.filename,
-                "audio_duration": analysis["duration"],
-                "audio_analysis": analysis,
-                "audio_data": audio_data,  # Store audio for playback reference
-                "updated_at": datetime.utcnow()
-            }}
+            {
+                "$set": {
+                    "audio_filename": audio.filename,
+                    "audio_duration": analysis["duration"],
+                    "audio_analysis": analysis,
+                    "audio_file_id": audio_file_id,
+                    "updated_at": datetime.now(timezone.utc)
+                },
+                "$unset": {"audio_data": ""}
+            },
+            projection={"audio_file_id": 1},
+            return_document=ReturnDocument.BEFORE
         )
+        invalidate_project(project_id)
+        if not previous:
+            await delete_audio_file(audio_file_id)
+            raise HTTPException(status_code=404, detail="Project not found")
+        if previous.get("audio_file_id"):
+            await delete_audio_file(previous["audio_file_id"])
         
         return {
             "message": "Audio analyzed successfully",
@@ -352,6 +574,60 @@ class AutoGenerateRequest(BaseModel):
     render_style: Optional[str] = None  # Retained style from previous successful renders
     scene_type: Optional[str] = None  # Optional scene type preference
 
+AUTOGEN_SYSTEM_TEMPLATE = """You are an expert music video director and scene writer.
+Your job is to create vivid, cinematic scene descriptions that match the RHYTHM and ENERGY of music.
+
+CRITICAL RULES:
+1. Each scene MUST sync with the audio's rhythm - use the tempo ({tempo} BPM) and energy levels
+2. High energy = fast cuts, dynamic movement, intense visuals
+3. Low energy = slow motion, contemplative shots, atmospheric scenes
+4. If lyrics are provided, they CLARIFY meaning - don't just visualize words literally
+5. Create VISUAL METAPHORS that capture the FEELING of the lyrics
+6. NO text/subtitles on screen - only pure visual storytelling
+7. Each description should be 2-3 detailed sentences
+
+RENDER STYLE TO USE: {render_style}
+(Apply this style consistently unless user changes it)
+
+Output ONLY valid JSON array."""
+
+AUTOGEN_PROMPT_TEMPLATE = """Analyze this song and create scene descriptions for EVERY segment.
+
+AUDIO ANALYSIS:
+- Duration: {duration} seconds
+- Tempo: {tempo} BPM
+- Total Segments: {num_segments}
+- Average Energy: {avg_energy}
+
+SEGMENT DATA (rhythm/energy per 8-second block):
+{segments_info}
+
+{lyrics_section}
+
+RENDER STYLE: {render_style}
+
+Generate a scene description for EACH of the {num_segments} segments.
+Match the scene intensity to the segment energy level.
+Sync camera movements to the beat (tempo: {tempo} BPM).
+
+Output JSON array:
+[
+  {{
+    "segment_number": 1,
+    "start_time": 0,
+    "end_time": 8,
+    "scene_description": "Detailed cinematic description matching the rhythm and energy...",
+    "camera_movement": "Movement synced to {tempo} BPM...",
+    "lighting": "Lighting that matches the mood...",
+    "mood": "Emotional tone of this segment...",
+    "render_style": "{render_style}",
+    "grok_prompt": "Complete prompt optimized for GROK 4.1 text-to-video generation..."
+  }}
+]"""
+
+# Per-segment fields sent to the model; beats_in_segment duplicates beat_density
+AUTOGEN_SEGMENT_FIELDS = ("segment_number", "start_time", "end_time", "energy", "intensity", "beat_density", "section_type")
+
 @api_router.post("/projects/{project_id}/auto-generate")
 async def auto_generate_scenes(project_id: str, request: AutoGenerateRequest):
     """
@@ -362,19 +638,18 @@ async def auto_generate_scenes(project_id: str, request: AutoGenerateRequest):
     3. AI generates scene descriptions for every 8-second segment
     4. User can then edit scene descriptions and render style
     """
-    project = await db.projects.find_one({"id": project_id})
+    # Check preconditions, read the project and flip it to processing in one round trip
+    project = await db.projects.find_one_and_update(
+        {"id": project_id, "audio_analysis": {"$nin": [None, {}]}},
+        {"$set": {"status": "processing"}},
+        projection=PROJECT_PROJECTION,
+        return_document=ReturnDocument.AFTER
+    )
+    invalidate_project(project_id)
     if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
+        await raise_for_unmatched(project_id, "Upload audio first - AI needs to analyze the rhythm")
     
-    audio_analysis = project.get("audio_analysis")
-    if not audio_analysis:
-        raise HTTPException(status_code=400, detail="Upload audio first - AI needs to analyze the rhythm")
-    
-    # Update status
-    await db.projects.update_one(
-        {"id": project_id},
-        {"$set": {"status": "processing"}}
-    )
+    audio_analysis = project["audio_analysis"]
     
     try:
         from emergentintegrations.llm.chat import LlmChat, UserMessage
@@ -410,73 +685,36 @@ async def auto_generate_scenes(project_id: str, request: AutoGenerateRequest):
         chat = LlmChat(
             api_key=api_key,
             session_id=f"autogen-{project_id}",
-            system_message=f"""You are an expert music video director and scene writer.
-Your job is to create vivid, cinematic scene descriptions that match the RHYTHM and ENERGY of music.
-
-CRITICAL RULES:
-1. Each scene MUST sync with the audio's rhythm - use the tempo ({tempo} BPM) and energy levels
-2. High energy = fast cuts, dynamic movement, intense visuals
-3. Low energy = slow motion, contemplative shots, atmospheric scenes
-4. If lyrics are provided, they CLARIFY meaning - don't just visualize words literally
-5. Create VISUAL METAPHORS that capture the FEELING of the lyrics
-6. NO text/subtitles on screen - only pure visual storytelling
-7. Each description should be 2-3 detailed sentences
-
-RENDER STYLE TO USE: {render_style}
-(Apply this style consistently unless user changes it)
-
-Output ONLY valid JSON array."""
+            system_message=AUTOGEN_SYSTEM_TEMPLATE.format(tempo=tempo, render_style=render_style)
         ).with_model("anthropic", "claude-sonnet-4-5-20250929")
         
-        # Build the prompt with all segment data
-        segments_info = json.dumps(segments, indent=2)
+        # Build the prompt with all segment data, compact and limited to what the model uses
+        segments_info = json.dumps(
+            [{k: seg[k] for k in AUTOGEN_SEGMENT_FIELDS if k in seg} for seg in segments],
+            separators=(',', ':')
+        )
         
-        prompt = f"""Analyze this song and create scene descriptions for EVERY segment.
-
-AUDIO ANALYSIS:
-- Duration: {audio_analysis.get('duration', 180)} seconds
-- Tempo: {tempo} BPM
-- Total Segments: {len(segments)}
-- Average Energy: {audio_analysis.get('avg_energy', 0.5)}
-
-SEGMENT DATA (rhythm/energy per 8-second block):
-{segments_info}
-
-{"LYRICS (to help understand the song - some words may be slang or unclear):" if lyrics else "NO LYRICS PROVIDED - create abstract visual story based on rhythm:"}
-{lyrics if lyrics else ""}
-
-RENDER STYLE: {render_style}
-
-Generate a scene description for EACH of the {len(segments)} segments.
-Match the scene intensity to the segment energy level.
-Sync camera movements to the beat (tempo: {tempo} BPM).
-
-Output JSON array:
-[
-  {{
-    "segment_number": 1,
-    "start_time": 0,
-    "end_time": 8,
-    "scene_description": "Detailed cinematic description matching the rhythm and energy...",
-    "camera_movement": "Movement synced to {tempo} BPM...",
-    "lighting": "Lighting that matches the mood...",
-    "mood": "Emotional tone of this segment...",
-    "render_style": "{render_style}",
-    "grok_prompt": "Complete prompt optimized for GROK 4.1 text-to-video generation..."
-  }}
-]"""
+        prompt = AUTOGEN_PROMPT_TEMPLATE.format(
+            duration=audio_analysis.get('duration', 180),
+            tempo=tempo,
+            num_segments=len(segments),
+            avg_energy=audio_analysis.get('avg_energy', 0.5),
+            segments_info=segments_info,
+            lyrics_section=(
+                f"LYRICS (to help understand the song - some words may be slang or unclear):\n{lyrics}"
+                if lyrics else "NO LYRICS PROVIDED - create abstract visual story based on rhythm:\n"
+            ),
+            render_style=render_style
+        )
         
         user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
+        response = await send_llm_message(chat, user_message)
         
         # Parse response
-        response_text = response.strip()
-        if "```json" in response_text:
-            response_text = response_text.split("```json")[1].split("```")[0]
-        elif "```" in response_text:
-            response_text = response_text.split("```")[1].split("```")[0]
+        match = JSON_FENCE_RE.search(response)
+        response_text = match.group(1) if match else response.strip()
         
-        scenes_data = json.loads(response_text)
+        scenes_data = orjson.loads(response_text)
         
         # Format scenes for storage
         storyboard = []
@@ -507,9 +745,10 @@ Output JSON array:
                 "status": "storyboard_ready",
                 "lyrics": lyrics if lyrics else project.get("lyrics"),
                 "retained_render_style": render_style,
-                "updated_at": datetime.utcnow()
+                "updated_at": datetime.now(timezone.utc)
             }}
         )
+        invalidate_project(project_id)
         
         return {
             "message": f"Auto-generated {len(storyboard)} scenes successfully!",
@@ -522,66 +761,67 @@ Output JSON array:
     except json.JSONDecodeError as e:
         logger.error(f"Failed to parse AI response: {e}")
         await db.projects.update_one({"id": project_id}, {"$set": {"status": "draft"}})
+        invalidate_project(project_id)
         raise HTTPException(status_code=500, detail="AI response parsing failed - please try again")
     except Exception as e:
         logger.error(f"Auto-generation error: {e}")
         await db.projects.update_one({"id": project_id}, {"$set": {"status": "draft"}})
-        raise HTTPException(status_code=500, detail=str(e))
+        invalidate_project(project_id)
+        raise HTTPException(status_code=503 if isinstance(e, LLMBusyError) else 500, detail=str(e))
+
+
+async def update_storyboard_scene(project_id: str, scene_id: str, update: SceneUpdateRequest) -> Dict[str, Any]:
+    """
+    Update one storyboard scene in place with the positional $ operator,
+    so only the changed fields travel to MongoDB. Returns the updated scene.
+    """
+    set_doc = {
+        f"storyboard.$.{key}": value
+        for key, value in update.model_dump(exclude={"project_id", "scene_id"}, exclude_none=True).items()
+    }
+    set_doc["updated_at"] = datetime.now(timezone.utc)
+    
+    updated = await db.projects.find_one_and_update(
+        {"id": project_id, "storyboard.id": scene_id},
+        {"$set": set_doc},
+        projection={"_id": 0, "storyboard": {"$elemMatch": {"id": scene_id}}},
+        return_document=ReturnDocument.AFTER
+    )
+    invalidate_project(project_id)
+    if not updated:
+        await raise_for_unmatched(project_id, "Scene not found", status_code=404)
+    
+    return updated["storyboard"][0]
 
 
 # Update single scene (user edits)
 @api_router.put("/projects/{project_id}/scenes/{scene_id}")
 async def update_single_scene(project_id: str, scene_id: str, update: SceneUpdateRequest):
     """User edits a single scene description or render style"""
-    project = await db.projects.find_one({"id": project_id})
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-    
-    storyboard = project.get("storyboard", [])
-    scene_found = False
-    
-    for i, scene in enumerate(storyboard):
-        if scene.get("id") == scene_id:
-            for key, value in update.dict().items():
-                if value is not None and key not in ["project_id", "scene_id"]:
-                    storyboard[i][key] = value
-            scene_found = True
-            break
-    
-    if not scene_found:
-        raise HTTPException(status_code=404, detail="Scene not found")
-    
-    await db.projects.update_one(
-        {"id": project_id},
-        {"$set": {
-            "storyboard": storyboard,
-            "updated_at": datetime.utcnow()
-        }}
-    )
-    
-    return {"message": "Scene updated successfully", "scene": storyboard[i]}
+    scene = await update_storyboard_scene(project_id, scene_id, update)
+    return {"message": "Scene updated successfully", "scene": scene}
 
 
 # Retain render style (user confirms a style works)
 @api_router.post("/projects/{project_id}/retain-style")
 async def retain_render_style(project_id: str, style: str = Form(...)):
     """User confirms a render style works - AI will use it for future scenes"""
-    project = await db.projects.find_one({"id": project_id})
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-    
-    await db.projects.update_one(
+    now = datetime.now(timezone.utc)
+    result = await db.projects.update_one(
         {"id": project_id},
         {"$set": {
             "retained_render_style": style,
-            "updated_at": datetime.utcnow()
+            "updated_at": now
         }}
     )
+    invalidate_project(project_id)
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Project not found")
     
     # Also save to user preferences for future projects
     await db.user_preferences.update_one(
         {"type": "render_style"},
-        {"$set": {"preferred_style": style, "updated_at": datetime.utcnow()}},
+        {"$set": {"preferred_style": style, "updated_at": now}},
         upsert=True
     )
     
@@ -590,68 +830,134 @@ async def retain_render_style(project_id: str, style: str = Form(...)):
 # Lyrics
 @api_router.post("/projects/{project_id}/lyrics")
 async def save_lyrics(project_id: str, lyrics_input: LyricsInput):
-    project = await db.projects.find_one({"id": project_id})
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-    
-    await db.projects.update_one(
+    result = await db.projects.update_one(
         {"id": project_id},
         {"$set": {
             "lyrics": lyrics_input.lyrics,
-            "updated_at": datetime.utcnow()
+            "updated_at": datetime.now(timezone.utc)
         }}
     )
+    invalidate_project(project_id)
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Project not found")
     
     return {"message": "Lyrics saved successfully"}
 
 # Theme
 @api_router.post("/projects/{project_id}/theme")
 async def save_theme(project_id: str, theme_input: ThemeInput):
-    project = await db.projects.find_one({"id": project_id})
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-    
-    await db.projects.update_one(
+    result = await db.projects.update_one(
         {"id": project_id},
         {"$set": {
             "theme_description": theme_input.theme_description,
-            "updated_at": datetime.utcnow()
+            "updated_at": datetime.now(timezone.utc)
         }}
     )
+    invalidate_project(project_id)
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Project not found")
     
     return {"message": "Theme saved successfully"}
 
-# Generate Storyboard with AI
-@api_router.post("/projects/{project_id}/generate-storyboard")
-async def generate_storyboard(project_id: str):
-    project = await db.projects.find_one({"id": project_id})
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-    
-    if not project.get("lyrics"):
-        raise HTTPException(status_code=400, detail="Lyrics are required to generate storyboard")
-    
-    if not project.get("audio_analysis"):
-        raise HTTPException(status_code=400, detail="Audio must be uploaded first")
-    
-    # Update status
-    await db.projects.update_one(
-        {"id": project_id},
-        {"$set": {"status": "processing"}}
-    )
-    
+# ==================== LLM HELPERS ====================
+
+# Cap in-flight Claude calls so slow upstream responses can't pile up
+LLM_CONCURRENCY = int(os.environ.get('LLM_CONCURRENCY', '8'))
+LLM_TIMEOUT_SECONDS = float(os.environ.get('LLM_TIMEOUT_SECONDS', '120'))
+llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+# Beyond the cap, wait this long for a slot and then fail fast instead of queueing forever
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('LLM_QUEUE_TIMEOUT_SECONDS', '10'))
+
+class LLMBusyError(Exception):
+    """All LLM slots stayed busy for LLM_QUEUE_TIMEOUT_SECONDS; surfaced to clients as 503"""
+
+# Rate limits and upstream 5xx are transient; retry them a few times with jitter.
+# Timeouts are not retried - LLM_TIMEOUT_SECONDS is already the latency budget.
+LLM_RETRY_ATTEMPTS = int(os.environ.get('LLM_RETRY_ATTEMPTS', '4'))
+LLM_RETRY_MAX_WAIT_SECONDS = 8.0
+LLM_RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504, 529}
+llm_backoff = wait_random_exponential(multiplier=0.5, max=LLM_RETRY_MAX_WAIT_SECONDS)
+
+def is_retryable_llm_error(exc: BaseException) -> bool:
+    if isinstance(exc, ConnectionError):
+        return True
+    return getattr(exc, "status_code", None) in LLM_RETRYABLE_STATUS_CODES
+
+def llm_retry_wait(retry_state) -> float:
+    """Honor the upstream Retry-After header when there is one, else jittered backoff"""
+    response = getattr(retry_state.outcome.exception(), "response", None)
     try:
-        from emergentintegrations.llm.chat import LlmChat, UserMessage
+        return min(float(response.headers["retry-after"]), LLM_RETRY_MAX_WAIT_SECONDS)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return llm_backoff(retry_state)
+
+async def send_llm_message(chat, user_message) -> str:
+    """
+    Send one LLM request, bounded by LLM_CONCURRENCY and LLM_TIMEOUT_SECONDS.
+    Raises LLMBusyError if no slot frees up within LLM_QUEUE_TIMEOUT_SECONDS.
+    Transient upstream errors are retried; the semaphore is released while backing off.
+    """
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(LLM_RETRY_ATTEMPTS),
+        wait=llm_retry_wait,
+        retry=retry_if_exception(is_retryable_llm_error),
+        reraise=True
+    ):
+        with attempt:
+            try:
+                await asyncio.wait_for(llm_semaphore.acquire(), timeout=LLM_QUEUE_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                raise LLMBusyError("AI service is busy - please try again shortly") from None
+            try:
+                return await asyncio.wait_for(chat.send_message(user_message), timeout=LLM_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"LLM request timed out after {LLM_TIMEOUT_SECONDS:.0f}s") from None
+            finally:
+                llm_semaphore.release()
+
+
+LLM_CACHE_CAPACITY = 256
+LLM_CACHE_TTL_SECONDS = 3600  # 1 hour
+
+def async_ttl_cache(capacity: int, ttl: float):
+    """
+    Memoize an async function on its positional arguments for `ttl` seconds.
+    Concurrent calls with the same arguments share one in-flight task, so a
+    burst of identical requests reaches the upstream service only once.
+    Failed calls are not cached.
+    """
+    def decorator(func):
+        cache: "OrderedDict[tuple, Tuple[float, asyncio.Future]]" = OrderedDict()
         
-        api_key = os.environ.get('EMERGENT_LLM_KEY')
-        if not api_key:
-            raise HTTPException(status_code=500, detail="LLM API key not configured")
+        @functools.wraps(func)
+        async def wrapper(*args):
+            now = time.monotonic()
+            entry = cache.get(args)
+            if entry is not None and entry[0] > now:
+                cache.move_to_end(args)
+                task = entry[1]
+            else:
+                task = asyncio.ensure_future(func(*args))
+                cache[args] = (now + ttl, task)
+                while len(cache) > capacity:
+                    cache.popitem(last=False)
+            
+            try:
+                return await asyncio.shield(task)
+            except Exception:
+                entry = cache.get(args)
+                if entry is not None and entry[1] is task:
+                    del cache[args]
+                raise
         
-        # Initialize Claude
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=f"storyboard-{project_id}",
-            system_message="""You are an expert cinematic storyboard creator for music videos. 
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+
+
+# Prompt skeletons are built once at import; only the per-request fields are filled in
+STORYBOARD_SYSTEM_MESSAGE = """You are an expert cinematic storyboard creator for music videos. 
 You create detailed, visually stunning scene descriptions that translate lyrics into dynamic, 
 narrative-driven video sequences. Focus on:
 - Camera movements (dolly, crane, tracking, handheld)
@@ -661,15 +967,8 @@ narrative-driven video sequences. Focus on:
 - NO text overlays, NO lyric subtitles, NO waveform visualizers
 - Only cinematic, story-driven motion like live-action or CGI
 Output JSON array of scenes."""
-        ).with_model("anthropic", "claude-sonnet-4-5-20250929")
-        
-        audio_analysis = project.get("audio_analysis", {})
-        lyrics = project.get("lyrics", "")
-        theme = project.get("theme_description", "cinematic music video")
-        duration = audio_analysis.get("duration", 180)
-        sections = audio_analysis.get("sections", [])
-        
-        prompt = f"""Create a cinematic storyboard for a music video based on these lyrics and theme.
+
+STORYBOARD_PROMPT_TEMPLATE = """Create a cinematic storyboard for a music video based on these lyrics and theme.
 
 THEME/MOOD: {theme}
 
@@ -678,8 +977,8 @@ LYRICS:
 
 AUDIO STRUCTURE:
 - Total Duration: {duration:.1f} seconds
-- Tempo: {audio_analysis.get('tempo', 120)} BPM
-- Sections: {json.dumps(sections)}
+- Tempo: {tempo} BPM
+- Sections: {sections_json}
 
 Create 6-10 scenes that:
 1. Match the audio sections (intro, verse, chorus, bridge, outro)
@@ -701,20 +1000,65 @@ Output ONLY a valid JSON array with this exact format:
     "lyric_segment": "Relevant lyrics"
   }}
 ]"""
+
+@async_ttl_cache(capacity=LLM_CACHE_CAPACITY, ttl=LLM_CACHE_TTL_SECONDS)
+async def llm_storyboard(lyrics: str, theme: str, duration: float, tempo: float, sections_json: str) -> List[dict]:
+    """Ask Claude for storyboard scenes. Identical inputs are served from cache."""
+    from emergentintegrations.llm.chat import LlmChat, UserMessage
+    
+    chat = LlmChat(
+        api_key=os.environ.get('EMERGENT_LLM_KEY'),
+        session_id=f"storyboard-{uuid.uuid4()}",
+        system_message=STORYBOARD_SYSTEM_MESSAGE
+    ).with_model("anthropic", "claude-sonnet-4-5-20250929")
+    
+    prompt = STORYBOARD_PROMPT_TEMPLATE.format(
+        theme=theme, lyrics=lyrics, duration=duration, tempo=tempo, sections_json=sections_json
+    )
+    
+    user_message = UserMessage(text=prompt)
+    response = await send_llm_message(chat, user_message)
+    
+    # Extract JSON from response
+    match = JSON_FENCE_RE.search(response)
+    response_text = match.group(1) if match else response.strip()
+    
+    try:
+        return orjson.loads(response_text)
+    except json.JSONDecodeError:
+        logger.error(f"Response was: {response}")
+        raise
+
+
+async def stream_scenes_json(message: str, scenes: List[dict]):
+    """Encode {"message": ..., "scenes": [...]} one scene at a time, so the first bytes go out early"""
+    yield b'{"message":' + orjson.dumps(message) + b',"scenes":['
+    for i, scene in enumerate(scenes):
+        yield (b"," if i else b"") + orjson.dumps(scene)
+    yield b"]}"
+
+
+async def run_storyboard_generation(project_id: str, project: dict):
+    """
+    Generate and save the storyboard for a project already marked as processing.
+    On failure the project is rolled back to draft.
+    """
+    try:
+        api_key = os.environ.get('EMERGENT_LLM_KEY')
+        if not api_key:
+            raise HTTPException(status_code=500, detail="LLM API key not configured")
         
-        user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
+        audio_analysis = project.get("audio_analysis", {})
+        lyrics = project.get("lyrics", "")
+        theme = project.get("theme_description", "cinematic music video")
+        duration = audio_analysis.get("duration", 180)
+        sections = audio_analysis.get("sections", [])
         
-        # Parse the response
+        # Generate scenes - identical inputs are served from the LLM cache
         try:
-            # Extract JSON from response
-            response_text = response.strip()
-            if "```json" in response_text:
-                response_text = response_text.split("```json")[1].split("```")[0]
-            elif "```" in response_text:
-                response_text = response_text.split("```")[1].split("```")[0]
-            
-            scenes_data = json.loads(response_text)
+            scenes_data = await llm_storyboard(
+                lyrics, theme, duration, audio_analysis.get('tempo', 120), json.dumps(sections)
+            )
             
             storyboard = []
             for scene_data in scenes_data:
@@ -728,7 +1072,7 @@ Output ONLY a valid JSON array with this exact format:
                     character_actions=scene_data.get("character_actions", ""),
                     lyric_segment=scene_data.get("lyric_segment", "")
                 )
-                storyboard.append(scene.dict())
+                storyboard.append(scene.model_dump())
             
             # Update project with storyboard
             await db.projects.update_one(
@@ -736,15 +1080,18 @@ Output ONLY a valid JSON array with this exact format:
                 {"$set": {
                     "storyboard": storyboard,
                     "status": "storyboard_ready",
-                    "updated_at": datetime.utcnow()
+                    "updated_at": datetime.now(timezone.utc)
                 }}
             )
+            invalidate_project(project_id)
             
-            return {"message": "Storyboard generated successfully", "scenes": storyboard}
+            return StreamingResponse(
+                stream_scenes_json("Storyboard generated successfully", storyboard),
+                media_type="application/json"
+            )
             
         except json.JSONDecodeError as e:
             logger.error(f"Failed to parse AI response: {e}")
-            logger.error(f"Response was: {response}")
             raise HTTPException(status_code=500, detail="Failed to parse AI response")
             
     except Exception as e:
@@ -753,37 +1100,65 @@ Output ONLY a valid JSON array with this exact format:
             {"id": project_id},
             {"$set": {"status": "draft"}}
         )
-        raise HTTPException(status_code=500, detail=str(e))
+        invalidate_project(project_id)
+        raise HTTPException(status_code=503 if isinstance(e, LLMBusyError) else 500, detail=str(e))
 
-# Update scene
-@api_router.put("/projects/{project_id}/scenes/{scene_id}")
-async def update_scene(project_id: str, scene_id: str, update: SceneUpdateRequest):
-    project = await db.projects.find_one({"id": project_id})
+
+# Generate Storyboard with AI
+@api_router.post("/projects/{project_id}/generate-storyboard")
+async def generate_storyboard(project_id: str):
+    # Check preconditions, read the project and flip it to processing in one round trip
+    project = await db.projects.find_one_and_update(
+        {"id": project_id, "lyrics": {"$nin": [None, ""]}, "audio_analysis": {"$nin": [None, {}]}},
+        {"$set": {"status": "processing"}},
+        projection=PROJECT_PROJECTION,
+        return_document=ReturnDocument.AFTER
+    )
+    invalidate_project(project_id)
     if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-    
-    storyboard = project.get("storyboard", [])
-    scene_found = False
+        await raise_for_unmatched(
+            project_id,
+            lambda found: "Audio must be uploaded first" if found.get("lyrics") else "Lyrics are required to generate storyboard",
+            projection={"lyrics": 1}
+        )
     
-    for i, scene in enumerate(storyboard):
-        if scene.get("id") == scene_id:
-            for key, value in update.dict().items():
-                if value is not None and key not in ["project_id", "scene_id"]:
-                    storyboard[i][key] = value
-            scene_found = True
-            break
+    return await run_storyboard_generation(project_id, project)
+
+class PrepareAndGenerateRequest(BaseModel):
+    lyrics: str
+    theme_description: Optional[str] = None
+
+# Save lyrics + theme and generate the storyboard in one call
+@api_router.post("/projects/{project_id}/prepare-and-generate")
+async def prepare_and_generate_storyboard(project_id: str, request: PrepareAndGenerateRequest):
+    """Combines the lyrics, theme and generate-storyboard calls into one Mongo round trip"""
+    if not request.lyrics.strip():
+        raise HTTPException(status_code=400, detail="Lyrics are required to generate storyboard")
     
-    if not scene_found:
-        raise HTTPException(status_code=404, detail="Scene not found")
+    set_doc = {
+        "lyrics": request.lyrics,
+        "status": "processing",
+        "updated_at": datetime.now(timezone.utc)
+    }
+    if request.theme_description is not None:
+        set_doc["theme_description"] = request.theme_description
     
-    await db.projects.update_one(
-        {"id": project_id},
-        {"$set": {
-            "storyboard": storyboard,
-            "updated_at": datetime.utcnow()
-        }}
+    project = await db.projects.find_one_and_update(
+        {"id": project_id, "audio_analysis": {"$nin": [None, {}]}},
+        {"$set": set_doc},
+        projection=PROJECT_PROJECTION,
+        return_document=ReturnDocument.AFTER
     )
+    invalidate_project(project_id)
+    if not project:
+        await raise_for_unmatched(project_id, "Audio must be uploaded first")
     
+    return await run_storyboard_generation(project_id, project)
+
+# Update scene
+@api_router.put("/projects/{project_id}/scenes/{scene_id}")
+async def update_scene(project_id: str, scene_id: str, update: SceneUpdateRequest):
+    await update_storyboard_scene(project_id, scene_id, update)
     return {"message": "Scene updated successfully"}
 
 # ==================== LYRICS BREAKDOWN ENDPOINT ====================
@@ -793,33 +1168,8 @@ class LyricsBreakdownRequest(BaseModel):
     theme: Optional[str] = "cinematic music video"
     block_duration: int = 8  # seconds per block
 
-@api_router.post("/breakdown-lyrics")
-async def breakdown_lyrics(request: LyricsBreakdownRequest):
-    """
-    AI-powered lyrics breakdown into 8-second video blocks.
-    Generates GROK 4.1 optimized prompts for each block.
-    """
-    if not request.lyrics.strip():
-        raise HTTPException(status_code=400, detail="Lyrics are required")
-    
-    try:
-        from emergentintegrations.llm.chat import LlmChat, UserMessage
-        
-        api_key = os.environ.get('EMERGENT_LLM_KEY')
-        if not api_key:
-            raise HTTPException(status_code=500, detail="LLM API key not configured")
-        
-        # Calculate approximate number of blocks based on lyrics length
-        # Roughly estimate 3-4 seconds per line of lyrics
-        lines = [l.strip() for l in request.lyrics.strip().split('\n') if l.strip()]
-        estimated_duration = len(lines) * 3.5  # rough estimate
-        num_blocks = max(4, int(estimated_duration / request.block_duration))
-        
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=f"breakdown-{uuid.uuid4()}",
-            system_message=f"""You are an expert at breaking down song lyrics into cinematic video scene blocks.
-Each block should be exactly {request.block_duration} seconds of video content.
+BREAKDOWN_SYSTEM_TEMPLATE = """You are an expert at breaking down song lyrics into cinematic video scene blocks.
+Each block should be exactly {block_duration} seconds of video content.
 Your output must be optimized for GROK 4.1 text-to-video generation.
 
 For each block, provide:
@@ -838,23 +1188,22 @@ CRITICAL RULES:
 - Each description should be 2-3 sentences minimum
 - Be extremely specific about visual details
 - Output ONLY valid JSON array"""
-        ).with_model("anthropic", "claude-sonnet-4-5-20250929")
-        
-        prompt = f"""Break down these lyrics into {num_blocks} cinematic video blocks of {request.block_duration} seconds each.
 
-THEME/VISUAL STYLE: {request.theme}
+BREAKDOWN_PROMPT_TEMPLATE = """Break down these lyrics into {num_blocks} cinematic video blocks of {block_duration} seconds each.
 
-LYRICS:
-{request.lyrics}
+THEME/VISUAL STYLE: {theme}
 
-Create exactly {num_blocks} scene blocks. Each block must be optimized for GROK 4.1 text-to-video AI.
+LYRICS:
+{lyrics}
+{slice_section}
+Create exactly {num_blocks} scene blocks, numbered from {first_block_number} and starting at {start_time} seconds. Each block must be optimized for GROK 4.1 text-to-video AI.
 
 Output ONLY a valid JSON array with this exact format:
 [
   {{
-    "block_number": 1,
-    "start_time": 0,
-    "end_time": {request.block_duration},
+    "block_number": {first_block_number},
+    "start_time": {start_time},
+    "end_time": {end_time},
     "lyric_segment": "The exact lyrics for this block",
     "description": "Extremely detailed cinematic scene description. Include environment, subjects, actions, colors, textures. Be specific enough for AI video generation.",
     "camera_movement": "Specific camera technique (slow dolly in, aerial tracking shot, handheld follow, etc.)",
@@ -864,35 +1213,211 @@ Output ONLY a valid JSON array with this exact format:
     "visual_style": "Reference style (photorealistic, cinematic CGI, anime-inspired, etc.)"
   }}
 ]"""
-        
-        user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
+
+BREAKDOWN_REPAIR_TEMPLATE = """Your previous reply could not be used: {problem}
+Reply again with ONLY the corrected JSON array of {num_blocks} blocks, in exactly the format requested."""
+
+# Shape every model reply must have before it is cached or returned
+BREAKDOWN_SCHEMA = {
+    "type": "array",
+    "minItems": 1,
+    "items": {
+        "type": "object",
+        "required": ["block_number", "lyric_segment", "description"],
+        "properties": {
+            "block_number": {"type": "integer"},
+            "start_time": {"type": "number"},
+            "end_time": {"type": "number"},
+            "lyric_segment": {"type": "string"},
+            "description": {"type": "string"},
+            "camera_movement": {"type": "string"},
+            "lighting": {"type": "string"},
+            "mood": {"type": "string"},
+            "character_actions": {"type": "string"},
+            "visual_style": {"type": "string"}
+        }
+    }
+}
+breakdown_validator = Draft202012Validator(BREAKDOWN_SCHEMA)
+BREAKDOWN_REPAIR_ATTEMPTS = 1
+
+# Appended when one request covers only part of the song; the full lyrics stay in the
+# prompt so every slice keeps the song's narrative and characters
+BREAKDOWN_SLICE_TEMPLATE = """
+This request covers only part of the song. Use the full lyrics above as context for story and character continuity, but create blocks ONLY for these lines:
+{slice_lyrics}
+"""
+
+@async_ttl_cache(capacity=LLM_CACHE_CAPACITY, ttl=LLM_CACHE_TTL_SECONDS)
+async def llm_breakdown(lyrics: str, slice_lyrics: Optional[str], theme: str, block_duration: int, num_blocks: int, first_block: int) -> List[dict]:
+    """
+    Ask Claude for lyric scene blocks, numbered from first_block + 1. An empty
+    slice_lyrics of None covers the whole song. Identical inputs are served from cache.
+    """
+    from emergentintegrations.llm.chat import LlmChat, UserMessage
+    
+    chat = LlmChat(
+        api_key=os.environ.get('EMERGENT_LLM_KEY'),
+        session_id=f"breakdown-{uuid.uuid4()}",
+        system_message=BREAKDOWN_SYSTEM_TEMPLATE.format(block_duration=block_duration)
+    ).with_model("anthropic", "claude-sonnet-4-5-20250929")
+    
+    prompt = BREAKDOWN_PROMPT_TEMPLATE.format(
+        num_blocks=num_blocks, block_duration=block_duration, theme=theme, lyrics=lyrics,
+        slice_section=BREAKDOWN_SLICE_TEMPLATE.format(slice_lyrics=slice_lyrics) if slice_lyrics is not None else "",
+        first_block_number=first_block + 1,
+        start_time=first_block * block_duration,
+        end_time=(first_block + 1) * block_duration
+    )
+    
+    user_message = UserMessage(text=prompt)
+    for _ in range(BREAKDOWN_REPAIR_ATTEMPTS + 1):
+        response = await send_llm_message(chat, user_message)
         
         # Parse the response
-        response_text = response.strip()
-        if "```json" in response_text:
-            response_text = response_text.split("```json")[1].split("```")[0]
-        elif "```" in response_text:
-            response_text = response_text.split("```")[1].split("```")[0]
+        match = JSON_FENCE_RE.search(response)
+        response_text = match.group(1) if match else response.strip()
         
-        scenes_data = json.loads(response_text)
+        try:
+            scenes_data = orjson.loads(response_text)
+        except orjson.JSONDecodeError as e:
+            problem = f"invalid JSON ({e})"
+        else:
+            error = best_match(breakdown_validator.iter_errors(scenes_data))
+            if error is None:
+                return scenes_data
+            problem = error.message
         
-        # Ensure proper formatting
-        formatted_scenes = []
-        for i, scene in enumerate(scenes_data):
-            formatted_scene = {
-                "block_number": scene.get("block_number", i + 1),
-                "start_time": scene.get("start_time", i * request.block_duration),
-                "end_time": scene.get("end_time", (i + 1) * request.block_duration),
-                "lyric_segment": scene.get("lyric_segment", ""),
-                "description": scene.get("description", ""),
-                "camera_movement": scene.get("camera_movement", ""),
-                "lighting": scene.get("lighting", ""),
-                "mood": scene.get("mood", ""),
-                "character_actions": scene.get("character_actions", ""),
-                "visual_style": scene.get("visual_style", "cinematic photorealistic"),
+        # Ask the same conversation to fix its reply rather than failing the request
+        logger.warning(f"Lyrics breakdown reply rejected: {problem}")
+        user_message = UserMessage(text=BREAKDOWN_REPAIR_TEMPLATE.format(problem=problem, num_blocks=num_blocks))
+    
+    raise ValueError(f"AI response did not match the block format: {problem}")
+
+# Fields kept from each model block, and the text defaults for any it leaves out
+BREAKDOWN_SCENE_DEFAULTS = {
+    "lyric_segment": "",
+    "description": "",
+    "camera_movement": "",
+    "lighting": "",
+    "mood": "",
+    "character_actions": "",
+    "visual_style": "cinematic photorealistic",
+}
+BREAKDOWN_SCENE_FIELDS = ("block_number", "start_time", "end_time", *BREAKDOWN_SCENE_DEFAULTS)
+
+# Typical sung-lyrics rate, used to estimate song length from the lyrics alone
+LYRICS_CHARS_PER_SECOND = 14
+
+# Long breakdowns are split into contiguous slices generated concurrently;
+# every request still goes through llm_semaphore
+BREAKDOWN_MAX_PARALLEL_REQUESTS = int(os.environ.get('BREAKDOWN_MAX_PARALLEL_REQUESTS', '4'))
+BREAKDOWN_MIN_BLOCKS_PER_REQUEST = 4
+
+async def generate_breakdown(lyrics: str, theme: str, block_duration: int, num_blocks: int) -> List[dict]:
+    """
+    Generate num_blocks lyric blocks. Decoding time grows with output length,
+    so long lyrics are partitioned by line into up to BREAKDOWN_MAX_PARALLEL_REQUESTS
+    slices that are requested at once and stitched back together in order.
+    Every slice sees the full lyrics; only its output is limited to its lines.
+    """
+    # Partition sung lines only - a slice made of stanza-break blank lines would be empty
+    lines = [line for line in lyrics.split('\n') if line.strip()]
+    parts = max(1, min(BREAKDOWN_MAX_PARALLEL_REQUESTS, num_blocks // BREAKDOWN_MIN_BLOCKS_PER_REQUEST, len(lines)))
+    if parts == 1:
+        return await llm_breakdown(lyrics, None, theme, block_duration, num_blocks, 0)
+    
+    # num_blocks is sized from characters, so cut the lines where each slice's share
+    # of the characters matches its share of the blocks
+    block_bounds = [num_blocks * k // parts for k in range(parts + 1)]
+    char_offsets = np.concatenate(([0], np.cumsum([len(line) for line in lines])))
+    cut_points = char_offsets[-1] * np.array(block_bounds[1:-1]) / num_blocks
+    line_bounds = [0, *np.searchsorted(char_offsets, cut_points).tolist(), len(lines)]
+    for k in range(1, parts):  # keep every slice non-empty
+        line_bounds[k] = min(max(line_bounds[k], line_bounds[k - 1] + 1), len(lines) - (parts - k))
+    slices = ["\n".join(lines[line_bounds[k]:line_bounds[k + 1]]) for k in range(parts)]
+    if any(not slice_lyrics.strip() for slice_lyrics in slices):
+        raise ValueError(f"Lyrics breakdown produced an empty slice: {line_bounds}")
+    
+    results = await asyncio.gather(*[
+        llm_breakdown(
+            lyrics, slices[k], theme, block_duration,
+            block_bounds[k + 1] - block_bounds[k], block_bounds[k]
+        )
+        for k in range(parts)
+    ])
+    return [scene for part in results for scene in part]
+
+# Three or more newlines = more than one blank line between stanzas
+BLANK_LINE_RUN_RE = re.compile(r"\n{3,}")
+
+def normalize_lyrics(lyrics: str) -> str:
+    """
+    Collapse whitespace within lines and runs of blank lines so re-pasted lyrics
+    share a cache entry. One blank line is kept between stanzas - the model uses
+    those verse/chorus breaks to place block boundaries.
+    """
+    lines = "\n".join(" ".join(line.split()) for line in lyrics.splitlines())
+    return BLANK_LINE_RUN_RE.sub("\n\n", lines).strip("\n")
+
+async def get_breakdown(lyrics: str, theme: str, block_duration: int, num_blocks: int) -> List[dict]:
+    """
+    Lyric blocks for normalized inputs. Results survive restarts and are shared
+    across workers via db.breakdown_cache; llm_breakdown's in-process cache
+    sits underneath for bursts within one worker.
+    """
+    cache_key = hashlib.sha256(
+        f"{lyrics}|{theme}|{block_duration}|{num_blocks}".encode('utf-8')
+    ).hexdigest()
+    cached = await db.breakdown_cache.find_one({"_id": cache_key}, {"scenes": 1})
+    if cached:
+        return cached["scenes"]
+    
+    scenes_data = await generate_breakdown(lyrics, theme, block_duration, num_blocks)
+    if scenes_data:
+        await db.breakdown_cache.update_one(
+            {"_id": cache_key},
+            {"$set": {"scenes": scenes_data, "created_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+    return scenes_data
+
+
+@api_router.post("/breakdown-lyrics")
+async def breakdown_lyrics(request: LyricsBreakdownRequest):
+    """
+    AI-powered lyrics breakdown into 8-second video blocks.
+    Generates GROK 4.1 optimized prompts for each block.
+    """
+    if not request.lyrics.strip():
+        raise HTTPException(status_code=400, detail="Lyrics are required")
+    
+    try:
+        api_key = os.environ.get('EMERGENT_LLM_KEY')
+        if not api_key:
+            raise HTTPException(status_code=500, detail="LLM API key not configured")
+        
+        # Calculate approximate number of blocks based on lyrics length -
+        # sung time tracks characters far better than line count
+        lyrics = normalize_lyrics(request.lyrics)
+        estimated_duration = sum(map(len, lyrics.split('\n'))) / LYRICS_CHARS_PER_SECOND
+        num_blocks = max(4, math.ceil(estimated_duration / request.block_duration))
+        
+        # Generate blocks - repeats of the same normalized inputs are served from cache
+        scenes_data = await get_breakdown(lyrics, request.theme, request.block_duration, num_blocks)
+        
+        # Ensure proper formatting - defaults first, then whatever the model supplied
+        block_duration = request.block_duration
+        formatted_scenes = [
+            {
+                "block_number": i + 1,
+                "start_time": i * block_duration,
+                "end_time": (i + 1) * block_duration,
+                **BREAKDOWN_SCENE_DEFAULTS,
+                **{key: scene[key] for key in BREAKDOWN_SCENE_FIELDS if key in scene}
             }
-            formatted_scenes.append(formatted_scene)
+            for i, scene in enumerate(scenes_data)
+        ]
         
         return {
             "message": "Lyrics breakdown complete",
@@ -907,28 +1432,24 @@ Output ONLY a valid JSON array with this exact format:
         raise HTTPException(status_code=500, detail="Failed to parse AI response")
     except Exception as e:
         logger.error(f"Error in lyrics breakdown: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise HTTPException(status_code=503 if isinstance(e, LLMBusyError) else 500, detail=str(e))
 
 
 # Generate Video (Mock)
 @api_router.post("/projects/{project_id}/generate-video")
 async def generate_video(project_id: str):
-    project = await db.projects.find_one({"id": project_id})
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-    
-    if not project.get("storyboard"):
-        raise HTTPException(status_code=400, detail="Storyboard must be generated first")
-    
-    # Mock video generation
-    await db.projects.update_one(
-        {"id": project_id},
+    # Mock video generation - only projects with a non-empty storyboard match
+    result = await db.projects.update_one(
+        {"id": project_id, "storyboard": {"$nin": [None, []]}},
         {"$set": {
             "status": "video_ready",
             "video_url": "mock://video-ready",  # Placeholder
-            "updated_at": datetime.utcnow()
+            "updated_at": datetime.now(timezone.utc)
         }}
     )
+    invalidate_project(project_id)
+    if result.matched_count == 0:
+        await raise_for_unmatched(project_id, "Storyboard must be generated first")
     
     return {
         "message": "Video generation complete (MOCK - integrate video AI API for real generation)",
@@ -952,141 +1473,208 @@ class DriveStatusResponse(BaseModel):
 @api_router.get("/drive/status")
 async def get_drive_status():
     """Check if Google Drive integration is configured"""
-    service = get_google_drive_service()
+    service = await asyncio.to_thread(get_google_drive_service)
     return {
         "configured": service is not None,
         "exports_folder_id": GDRIVE_EXPORTS_FOLDER_ID,
         "multi_folder_id": GDRIVE_MULTI_FOLDER_ID,
     }
 
-@api_router.post("/drive/upload")
-async def upload_to_drive(request: DriveUploadRequest):
+# A folder upload still claimed after this long belongs to a job that died; re-exports retry it
+DRIVE_PENDING_TIMEOUT_SECONDS = 15 * 60
+
+# Exports below this size go up in a single request instead of resumable chunks
+DRIVE_RESUMABLE_THRESHOLD = 5 * 1024 * 1024
+
+# (request flag, folder id, folder name, export record field prefix)
+DRIVE_BACKUP_TARGETS = (
+    ("cloud_backup", GDRIVE_EXPORTS_FOLDER_ID, "EXPORTS", "cloud"),
+    ("dual_backup", GDRIVE_MULTI_FOLDER_ID, "MULTI", "dual"),
+)
+
+def create_drive_file(filename: str, content: bytes, folder_id: str) -> dict:
+    """
+    Blocking Drive upload, meant for a worker thread. The shared service only
+    builds the request; httplib2 connections are not thread-safe, so each
+    upload executes on its own authorized Http.
+    """
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.http import MediaInMemoryUpload
+    
+    service = get_google_drive_service()
+    if not service:
+        raise RuntimeError("Google Drive not configured")
+    
+    # The bytes are immutable, so concurrent uploads share them without copying
+    media = MediaInMemoryUpload(
+        content, mimetype='text/plain', resumable=len(content) >= DRIVE_RESUMABLE_THRESHOLD
+    )
+    return service.files().create(
+        body={'name': filename, 'parents': [folder_id]},
+        media_body=media,
+        fields='id, name, webViewLink'
+    ).execute(http=AuthorizedHttp(drive_credentials, http=httplib2.Http()))
+
+async def backup_to_drive(filename: str, content: bytes, folder_id: str, folder: str, field_prefix: str) -> dict:
+    """Upload one copy off the event loop and return its export record fields; never raises"""
+    try:
+        uploaded_file = await asyncio.to_thread(create_drive_file, filename, content, folder_id)
+    except Exception as e:
+        logger.error(f"{folder} folder upload failed: {e}")
+        outcome = {f"{field_prefix}_error": str(e)}
+    else:
+        outcome = {
+            f"{field_prefix}_uploaded": True,
+            f"{field_prefix}_file_id": uploaded_file.get('id'),
+            f"{field_prefix}_link": uploaded_file.get('webViewLink')
+        }
+    return outcome
+
+async def run_drive_backups(export_id: str, filename: str, content: bytes, targets: tuple, started_at: datetime):
+    """Background half of /drive/upload: both folders are independent, so upload concurrently"""
+    outcomes = await asyncio.gather(*[
+        backup_to_drive(filename, content, folder_id, folder, field_prefix)
+        for _, folder_id, folder, field_prefix in targets
+    ])
+    
+    # Record every folder's outcome in one write. A folder's claim is released only
+    # if it is still ours - a stale job must not clear a newer retry's claim - and the
+    # export stays pending while any other folder is still claimed.
+    outcome_fields = {key: {"$literal": value} for outcome in outcomes for key, value in outcome.items()}
+    for (_, _, _, prefix), outcome in zip(targets, outcomes):
+        if outcome.get(f"{prefix}_uploaded"):
+            outcome_fields[f"{prefix}_error"] = "$$REMOVE"  # drop the error left by an earlier failed attempt
+    released = {
+        f"{prefix}_started_at": {
+            "$cond": [{"$eq": [f"${prefix}_started_at", started_at]}, "$$REMOVE", f"${prefix}_started_at"]
+        }
+        for _, _, _, prefix in targets
+    }
+    still_claimed = [{"$ifNull": [f"${prefix}_started_at", False]} for _, _, _, prefix in DRIVE_BACKUP_TARGETS]
+    await db.storyboard_exports.update_one({"id": export_id}, [
+        {"$set": {**outcome_fields, **released}},
+        {"$set": {"drive_status": {"$cond": [{"$or": still_claimed}, "pending", "done"]}}}
+    ])
+
+async def claim_drive_target(export_id: str, field_prefix: str, started_at: datetime) -> bool:
+    """
+    Claim one folder of an existing export for upload. Succeeds only if the folder has
+    no copy yet and no live claim; claims older than DRIVE_PENDING_TIMEOUT_SECONDS
+    belong to jobs that died and are taken over.
+    """
+    stale_before = started_at - timedelta(seconds=DRIVE_PENDING_TIMEOUT_SECONDS)
+    result = await db.storyboard_exports.update_one(
+        {
+            "id": export_id,
+            f"{field_prefix}_uploaded": {"$ne": True},
+            "$or": [
+                {f"{field_prefix}_started_at": None},
+                {f"{field_prefix}_started_at": {"$lt": stale_before}}
+            ]
+        },
+        {"$set": {f"{field_prefix}_started_at": started_at, "drive_status": "pending"}}
+    )
+    return result.modified_count == 1
+
+@api_router.post("/drive/upload", status_code=202)
+async def upload_to_drive(request: DriveUploadRequest, background_tasks: BackgroundTasks):
     """
-    Upload storyboard export to Google Drive folders.
+    Save a storyboard export and queue its Google Drive backups.
     - cloud_backup: Upload to EXPORTS folder
-    - dual_backup: Upload to MULTI folder  
+    - dual_backup: Upload to MULTI folder
+    Drive uploads run after the response is sent; poll /drive/status/{export_id}.
     """
+    targets = tuple(target for target in DRIVE_BACKUP_TARGETS if getattr(request, target[0]))
     results = {
         "local_saved": True,
-        "cloud_backup": None,
-        "dual_backup": None,
+        "export_id": str(uuid.uuid4()),
+        "accepted": False,
+        "duplicate": False,
         "errors": []
     }
     
-    # Always save to database as backup
+    if targets and not await asyncio.to_thread(get_google_drive_service):
+        results["errors"].append("Google Drive not configured. Please add service account credentials.")
+        targets = ()
+    
+    # Always save to database as backup - identical content shares one record.
+    # Each queued folder carries a {prefix}_started_at claim until its upload finishes.
+    content = request.content.encode('utf-8')
+    now = datetime.now(timezone.utc)
+    now = now.replace(microsecond=now.microsecond // 1000 * 1000)  # BSON dates hold milliseconds; claims compare exactly
     export_record = {
-        "id": str(uuid.uuid4()),
+        "id": results["export_id"],
         "filename": request.filename,
         "content": request.content,
-        "created_at": datetime.utcnow(),
+        "content_hash": hashlib.sha256(content).hexdigest(),
+        "created_at": now,
         "cloud_uploaded": False,
         "dual_uploaded": False,
+        "drive_status": "pending" if targets else "skipped",
+        **{f"{prefix}_started_at": now for _, _, _, prefix in targets},
     }
-    await db.storyboard_exports.insert_one(export_record)
+    existing = await db.storyboard_exports.find_one_and_update(
+        {"content_hash": export_record["content_hash"]},
+        {"$setOnInsert": export_record},
+        projection={"id": 1},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+    
+    if existing:
+        # Re-export of the same bytes: queue only folders with no copy and no upload in flight
+        results["export_id"] = existing["id"]
+        results["duplicate"] = True
+        claimed = [await claim_drive_target(existing["id"], target[3], now) for target in targets]
+        targets = tuple(target for target, ok in zip(targets, claimed) if ok)
     
     # Upload to Google Drive if requested
-    if request.cloud_backup or request.dual_backup:
-        service = get_google_drive_service()
-        
-        if not service:
-            results["errors"].append("Google Drive not configured. Please add service account credentials.")
-            return results
-        
-        try:
-            from googleapiclient.http import MediaIoBaseUpload
-            
-            # Prepare file content
-            file_content = io.BytesIO(request.content.encode('utf-8'))
-            media = MediaIoBaseUpload(file_content, mimetype='text/plain', resumable=True)
-            
-            # Upload to EXPORTS folder (CLOUD backup)
-            if request.cloud_backup:
-                try:
-                    file_metadata = {
-                        'name': request.filename,
-                        'parents': [GDRIVE_EXPORTS_FOLDER_ID]
-                    }
-                    file_content.seek(0)
-                    media = MediaIoBaseUpload(file_content, mimetype='text/plain', resumable=True)
-                    
-                    uploaded_file = service.files().create(
-                        body=file_metadata,
-                        media_body=media,
-                        fields='id, name, webViewLink'
-                    ).execute()
-                    
-                    results["cloud_backup"] = {
-                        "success": True,
-                        "file_id": uploaded_file.get('id'),
-                        "file_name": uploaded_file.get('name'),
-                        "link": uploaded_file.get('webViewLink'),
-                        "folder": "EXPORTS"
-                    }
-                    
-                    # Update database record
-                    await db.storyboard_exports.update_one(
-                        {"id": export_record["id"]},
-                        {"$set": {"cloud_uploaded": True, "cloud_file_id": uploaded_file.get('id')}}
-                    )
-                    
-                except Exception as e:
-                    logger.error(f"EXPORTS folder upload failed: {e}")
-                    results["cloud_backup"] = {"success": False, "error": str(e)}
-                    results["errors"].append(f"CLOUD backup failed: {str(e)}")
-            
-            # Upload to MULTI folder (DUAL backup)
-            if request.dual_backup:
-                try:
-                    file_metadata = {
-                        'name': request.filename,
-                        'parents': [GDRIVE_MULTI_FOLDER_ID]
-                    }
-                    file_content.seek(0)
-                    media = MediaIoBaseUpload(file_content, mimetype='text/plain', resumable=True)
-                    
-                    uploaded_file = service.files().create(
-                        body=file_metadata,
-                        media_body=media,
-                        fields='id, name, webViewLink'
-                    ).execute()
-                    
-                    results["dual_backup"] = {
-                        "success": True,
-                        "file_id": uploaded_file.get('id'),
-                        "file_name": uploaded_file.get('name'),
-                        "link": uploaded_file.get('webViewLink'),
-                        "folder": "MULTI"
-                    }
-                    
-                    # Update database record
-                    await db.storyboard_exports.update_one(
-                        {"id": export_record["id"]},
-                        {"$set": {"dual_uploaded": True, "dual_file_id": uploaded_file.get('id')}}
-                    )
-                    
-                except Exception as e:
-                    logger.error(f"MULTI folder upload failed: {e}")
-                    results["dual_backup"] = {"success": False, "error": str(e)}
-                    results["errors"].append(f"DUAL backup failed: {str(e)}")
-                    
-        except Exception as e:
-            logger.error(f"Google Drive upload error: {e}")
-            results["errors"].append(str(e))
+    if targets:
+        background_tasks.add_task(run_drive_backups, results["export_id"], request.filename, content, targets, now)
+        results["accepted"] = True
     
     return results
 
+@api_router.get("/drive/status/{export_id}")
+async def get_drive_export_status(export_id: str):
+    """Drive backup progress for one export"""
+    export = await db.storyboard_exports.find_one({"id": export_id}, {"_id": 0, "content": 0})
+    if not export:
+        raise HTTPException(status_code=404, detail="Export not found")
+    return export
+
 
 # Include the router in the main app
 app.include_router(api_router)
 
+# Comma-separated list of allowed web origins, e.g. "https://app.example.com"
+CORS_ORIGINS = [o.strip() for o in os.environ.get('CORS_ORIGINS', '*').split(',') if o.strip()]
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=CORS_ORIGINS,
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
+    allow_headers=["content-type", "authorization"],
+    max_age=86400,  # let browsers cache preflight results for a day
 )
 
+@app.on_event("startup")
+async def create_db_indexes():
+    # Every endpoint looks projects up by "id"; scene edits filter on storyboard.id
+    await db.projects.create_index("id", unique=True)
+    await db.projects.create_index("storyboard.id")
+    await db.projects.create_index([("created_at", -1)])
+    await db.audio_analysis_cache.create_index("created_at", expireAfterSeconds=AUDIO_ANALYSIS_CACHE_TTL_SECONDS)
+    await db.breakdown_cache.create_index("created_at", expireAfterSeconds=BREAKDOWN_CACHE_TTL_SECONDS)
+    # Drive status polls and background uploads look exports up by "id"; re-exports by content hash
+    await db.storyboard_exports.create_index("id", unique=True)
+    await db.storyboard_exports.create_index(
+        "content_hash", unique=True, partialFilterExpression={"content_hash": {"$type": "string"}}
+    )
+    await db.storyboard_exports.create_index([("cloud_uploaded", 1), ("created_at", -1)])
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
+    await client.close()